@@ -1,25 +1,46 @@
-import glob
+import base64
+import functools
+import logging
 import os
 from typing import *
-from insightface.app.common import Face
-from safetensors.torch import save_file, safe_open
-import torch
+from safetensors import safe_open
+from safetensors.numpy import (
+    load as st_load_bytes_np,
+    load_file as st_load_np,
+    save as st_save_bytes_np,
+)
+import numpy as np
 
 import modules.scripts as scripts
 from modules import scripts
 from scripts.faceswaplab_swapping.upcaled_inswapper_options import InswappperOptions
 from scripts.faceswaplab_utils.faceswaplab_logging import logger
+from scripts.faceswaplab_globals import REFERENCE_PATH
 from scripts.faceswaplab_utils.typing import *
-from scripts.faceswaplab_utils import imgutils
-from scripts.faceswaplab_utils.models_utils import get_swap_models
 import traceback
 
-from scripts.faceswaplab_swapping import swapper
 from pprint import pformat
 import re
-from client_api import api_utils
 import tempfile
 
+_SANITIZE_RE = re.compile(r"[^A-Za-z0-9_. ]+")
+_SPACE_TABLE = str.maketrans({" ": "_"})
+
+# os.umask can only be read by setting it, do it once at import
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+# Options used to render checkpoint previews, shared by all builds (the swapper does not modify them)
+_PREVIEW_SWAPPING_OPTIONS = InswappperOptions(
+    face_restorer_name="CodeFormer",
+    restorer_visibility=1,
+    upscaler_name="Lanczos",
+    codeformer_weight=1,
+    improved_mask=True,
+    color_corrections=False,
+    sharpen=True,
+)
+
 
 def sanitize_name(name: str) -> str:
     """
@@ -31,9 +52,80 @@ def sanitize_name(name: str) -> str:
     Returns:
         str: The sanitized name with special characters removed and spaces replaced by underscores.
     """
-    name = re.sub("[^A-Za-z0-9_. ]+", "", name)
-    name = name.replace(" ", "_")
-    return name[:255]
+    return _SANITIZE_RE.sub("", name).translate(_SPACE_TABLE)[:255]
+
+
+def _reference_detection_settings() -> Tuple[Tuple[str, str], ...]:
+    """
+    Detection settings the reference faces depend on. They are stored with the persisted faces,
+    which are only reused while the settings are unchanged.
+    """
+    from scripts.faceswaplab_utils.sd_utils import get_sd_option
+
+    return (
+        (
+            "detection_threshold",
+            str(get_sd_option("faceswaplab_detection_threshold", 0.5)),
+        ),
+        ("auto_det_size", str(get_sd_option("faceswaplab_auto_det_size", True))),
+        ("det_size", str(get_sd_option("faceswaplab_det_size", 640))),
+    )
+
+
+def _detect_reference_face(
+    image_path: str, img: PILImage, detection_settings: Tuple[Tuple[str, str], ...]
+) -> Optional[Face]:
+    """
+    Detect the face of a reference image. The detected face is stored next to the image
+    ("<name>.face.safetensors") and loaded instead of running the detection again, until the image
+    or the detection settings are modified.
+    """
+    from scripts.faceswaplab_swapping import swapper
+    from scripts.faceswaplab_utils import imgutils
+
+    metadata = dict(detection_settings)
+    face_path = os.path.splitext(image_path)[0] + ".face.safetensors"
+    if os.path.exists(face_path) and os.path.getmtime(face_path) >= os.path.getmtime(
+        image_path
+    ):
+        try:
+            with safe_open(face_path, framework="np") as f:
+                if f.metadata() == metadata:
+                    return Face({k: f.get_tensor(k) for k in f.keys()})
+            logger.info("Detection settings changed, detecting %s again", image_path)
+        except Exception as e:
+            logger.warning("Failed to load reference face %s : %s", face_path, e)
+
+    target_face = swapper.get_or_default(
+        swapper.get_faces(imgutils.pil_to_cv2(img)), 0, None
+    )
+    if target_face is not None and os.access(os.path.dirname(face_path), os.W_OK):
+        try:
+            _write_safetensors(
+                {k: np.array(v) for k, v in target_face.items() if v is not None},
+                face_path,
+                metadata=metadata,
+            )
+        except Exception as e:
+            logger.warning("Failed to save reference face %s : %s", face_path, e)
+    return target_face
+
+
+@functools.lru_cache(maxsize=2)
+def _reference_for_gender(
+    gender: int, detection_settings: Tuple[Tuple[str, str], ...]
+) -> Tuple[PILImage, Optional[Face]]:
+    """
+    Load the reference image used for checkpoint previews and its face.
+
+    The reference images never change, so the decoded image and the face are kept
+    for subsequent builds with the same detection settings.
+    """
+    image_path = os.path.join(REFERENCE_PATH, "woman.png" if gender == 0 else "man.png")
+    img = Image.open(image_path)
+    # Decode now, this also releases the file handle
+    img.load()
+    return img, _detect_reference_face(image_path, img, detection_settings)
 
 
 def build_face_checkpoint_and_save(
@@ -55,6 +147,9 @@ def build_face_checkpoint_and_save(
     Returns:
         PIL.PILImage or None: The resulting swapped face image if the process is successful; None otherwise.
     """
+    # Imported here to keep checkpoint listing and loading free of the swapping stack (and its import cycle)
+    from scripts.faceswaplab_swapping import swapper
+    from scripts.faceswaplab_utils.models_utils import get_swap_models
 
     try:
         name = sanitize_name(name)
@@ -66,28 +161,18 @@ def build_face_checkpoint_and_save(
             return None
 
         blended_face: Optional[Face] = swapper.blend_faces(faces, gender=gender)
-        preview_path = os.path.join(
-            scripts.basedir(), "extensions", "sd-webui-faceswaplab", "references"
-        )
 
-        reference_preview_img: PILImage
         if blended_face:
-            if blended_face["gender"] == 0:
-                reference_preview_img = Image.open(
-                    os.path.join(preview_path, "woman.png")
-                )
-            else:
-                reference_preview_img = Image.open(
-                    os.path.join(preview_path, "man.png")
-                )
-
             if name == "":
                 name = "default_name"
-            logger.debug("Face %s", pformat(blended_face))
-            target_face = swapper.get_or_default(
-                swapper.get_faces(imgutils.pil_to_cv2(reference_preview_img)), 0, None
+            if logger.getEffectiveLevel() <= logging.DEBUG:
+                logger.debug("Face %s", pformat(blended_face))
+            reference_preview_img, target_face = _reference_for_gender(
+                int(blended_face["gender"]), _reference_detection_settings()
             )
             if target_face is None:
+                # Do not keep the failed detection, the next build will retry
+                _reference_for_gender.cache_clear()
                 logger.error(
                     "Failed to open reference image, cannot create preview : That should not happen unless you deleted the references folder or change the detection threshold."
                 )
@@ -97,15 +182,7 @@ def build_face_checkpoint_and_save(
                     source_face=blended_face,
                     target_img=reference_preview_img,
                     model=get_swap_models()[0],
-                    swapping_options=InswappperOptions(
-                        face_restorer_name="CodeFormer",
-                        restorer_visibility=1,
-                        upscaler_name="Lanczos",
-                        codeformer_weight=1,
-                        improved_mask=True,
-                        color_corrections=False,
-                        sharpen=True,
-                    ),
+                    swapping_options=_PREVIEW_SWAPPING_OPTIONS,
                 )
                 preview_image = result.image
 
@@ -116,21 +193,16 @@ def build_face_checkpoint_and_save(
                         get_checkpoint_path(), f"{name}.safetensors"
                     )
                     if not overwrite:
-                        file_number = 1
-                        while os.path.exists(file_path):
-                            file_path = os.path.join(
-                                get_checkpoint_path(),
-                                f"{name}_{file_number}.safetensors",
-                            )
-                            file_number += 1
+                        file_path = _next_free_checkpoint_path(name)
                 save_face(filename=file_path, face=blended_face)
                 preview_image.save(file_path + ".png")
-                try:
-                    data = load_face(file_path)
-                    logger.debug(data)
-                except Exception as e:
-                    logger.error("Error loading checkpoint, after creation %s", e)
-                    traceback.print_exc()
+                if logger.getEffectiveLevel() <= logging.DEBUG:
+                    try:
+                        data = load_face(file_path)
+                        logger.debug(data)
+                    except Exception as e:
+                        logger.error("Error loading checkpoint, after creation %s", e)
+                        traceback.print_exc()
 
                 return preview_image
 
@@ -143,62 +215,146 @@ def build_face_checkpoint_and_save(
         return None
 
 
+def _next_free_checkpoint_path(name: str) -> str:
+    """
+    Return the path of "<name>.safetensors", or of the first unused "<name>_<n>.safetensors" if it is taken.
+    Candidates are checked against a single directory listing instead of one stat call each.
+    """
+    index = _checkpoint_index()
+    file_name = f"{name}.safetensors"
+    file_number = 1
+    while file_name in index:
+        file_name = f"{name}_{file_number}.safetensors"
+        file_number += 1
+    return os.path.join(get_checkpoint_path(), file_name)
+
+
+def _write_safetensors(
+    tensors: Dict[str, np.ndarray],
+    filename: str,
+    metadata: Optional[Dict[str, str]] = None,
+) -> None:
+    """
+    Serialize the tensors in memory and write them with a single write call.
+    The file is written next to its destination and renamed, so readers never see a partial file.
+    """
+    data = st_save_bytes_np(tensors, metadata=metadata)
+    # The directory may have been removed since get_checkpoint_path created it
+    os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+    # Each writer gets its own temporary file, so concurrent saves of the same file do not collide
+    fd, tmp_filename = tempfile.mkstemp(
+        dir=os.path.dirname(filename) or ".", suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        # mkstemp creates the file as 0600, give it the permissions a plain open would have used
+        os.chmod(tmp_filename, 0o666 & ~_UMASK)
+        os.replace(tmp_filename, filename)
+    except Exception:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+
+
 def save_face(face: Face, filename: str) -> None:
     try:
         tensors = {
-            "embedding": torch.tensor(face["embedding"]),
-            "gender": torch.tensor(face["gender"]),
-            "age": torch.tensor(face["age"]),
+            "embedding": np.ascontiguousarray(face["embedding"]),
+            "gender": np.asarray(face["gender"]),
+            "age": np.asarray(face["age"]),
         }
-        save_file(tensors, filename)
+        _write_safetensors(tensors, filename)
+        _list_checkpoint_dir.cache_clear()
+        _load_face_tensors.cache_clear()
     except Exception as e:
-        traceback.print_exc
+        traceback.print_exc()
         logger.error("Failed to save checkpoint %s", e)
         raise e
 
 
+@functools.lru_cache(maxsize=None)
+def _warn_deprecated_pkl(filename: str) -> None:
+    # Cached so that a pkl selected in a unit only warns once and not on every generation
+    logger.warning(
+        "Pkl files for faces are deprecated to enhance safety, you need to convert them (%s)",
+        filename,
+    )
+    logger.warning(
+        "You can use this script https://gist.github.com/glucauze/4a3c458541f2278ad801f6625e5b9d3d"
+    )
+
+
+@functools.lru_cache(maxsize=16)
+def _load_face_tensors(
+    filename: str, mtime_ns: int, size: int, ino: int
+) -> Dict[str, np.ndarray]:
+    """
+    Read the tensors of a face checkpoint. The result is reused as long as the file is not modified
+    (modification time, size and inode are part of the cache key), each load_face call still gets its own Face.
+    The arrays are shared between those faces and are made read-only so that an in-place update cannot alter the cache.
+    """
+    tensors = st_load_np(filename)
+    for tensor in tensors.values():
+        tensor.setflags(write=False)
+    return tensors
+
+
 def load_face(name: str) -> Optional[Face]:
     if name.startswith("data:application/face;base64,"):
-        with tempfile.NamedTemporaryFile(delete=True) as temp_file:
-            api_utils.base64_to_safetensors(name, temp_file.name)
-            face = {}
-            with safe_open(temp_file.name, framework="pt", device="cpu") as f:
-                for k in f.keys():
-                    logger.debug("load key %s", k)
-                    face[k] = f.get_tensor(k).numpy()
-            return Face(face)
+        # Deserialize in memory rather than round-tripping through a temporary file
+        return Face(st_load_bytes_np(base64.b64decode(name.split("base64,")[-1])))
 
     filename = matching_checkpoint(name)
     if filename is None:
         return None
 
     if filename.endswith(".pkl"):
-        logger.warning(
-            "Pkl files for faces are deprecated to enhance safety, you need to convert them"
-        )
-        logger.warning("The file will be converted to .safetensors")
-        logger.warning(
-            "You can also use this script https://gist.github.com/glucauze/4a3c458541f2278ad801f6625e5b9d3d"
-        )
-        return None
+        # Pkl files are never unpickled, use the converted checkpoint if there is one
+        converted = filename[: -len(".pkl")] + ".safetensors"
+        if not os.path.exists(converted):
+            _warn_deprecated_pkl(filename)
+            return None
+        filename = converted
 
-    elif filename.endswith(".safetensors"):
-        face = {}
-        with safe_open(filename, framework="pt", device="cpu") as f:
-            for k in f.keys():
-                logger.debug("load key %s", k)
-                face[k] = f.get_tensor(k).numpy()
-        return Face(face)
+    if filename.endswith(".safetensors"):
+        stat = os.stat(filename)
+        return Face(
+            _load_face_tensors(filename, stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        )
 
     raise NotImplementedError("Unknown file type, face extraction not implemented")
 
 
+@functools.lru_cache(maxsize=1)
 def get_checkpoint_path() -> str:
     checkpoint_path = os.path.join(scripts.basedir(), "models", "faceswaplab", "faces")
     os.makedirs(checkpoint_path, exist_ok=True)
     return checkpoint_path
 
 
+@functools.lru_cache(maxsize=1)
+def _list_checkpoint_dir(mtime_ns: int) -> FrozenSet[str]:
+    with os.scandir(get_checkpoint_path()) as it:
+        return frozenset(entry.name for entry in it if entry.is_file())
+
+
+def _checkpoint_index() -> FrozenSet[str]:
+    """
+    Snapshot of the file names present in the checkpoint directory.
+
+    The snapshot is keyed on the directory modification time, so files added or removed outside of
+    the extension are picked up while repeated lookups only cost a single stat call.
+    """
+    checkpoint_path = get_checkpoint_path()
+    try:
+        return _list_checkpoint_dir(os.stat(checkpoint_path).st_mtime_ns)
+    except FileNotFoundError:
+        # The directory was removed while the webui is running, it is recreated on the next save
+        _list_checkpoint_dir.cache_clear()
+        return frozenset()
+
+
 def matching_checkpoint(name: str) -> Optional[str]:
     """
     Retrieve the full path of a checkpoint file matching the given name.
@@ -220,10 +376,10 @@ def matching_checkpoint(name: str) -> Optional[str]:
     # If the name doesn't end with the specified extensions, look for a matching file
     if not (name.endswith(".safetensors") or name.endswith(".pkl")):
         # Try appending each extension and check if the file exists in the checkpoint path
+        index = _checkpoint_index()
         for ext in [".safetensors", ".pkl"]:
-            full_path = os.path.join(get_checkpoint_path(), name + ext)
-            if os.path.exists(full_path):
-                return full_path
+            if name + ext in index:
+                return os.path.join(get_checkpoint_path(), name + ext)
         # If no matching file is found, return None
         return None
 
@@ -233,18 +389,16 @@ def matching_checkpoint(name: str) -> Optional[str]:
 
 def get_face_checkpoints() -> List[str]:
     """
-    Retrieve a list of face checkpoint paths.
+    Retrieve a list of face checkpoint names.
 
-    This function searches for face files with the extension ".safetensors" in the specified directory and returns a list
-    containing the paths of those files.
+    This function lists the face files with the extensions ".safetensors" or ".pkl" in the checkpoint directory.
+    It shares the directory snapshot used by matching_checkpoint, so the directory is only scanned again
+    when its content changed.
 
     Returns:
-        list: A list of face paths, including the string "None" as the first element.
+        list: A list of face file names, including the string "None" as the first element.
     """
-    faces_path = os.path.join(get_checkpoint_path(), "*.safetensors")
-    faces = glob.glob(faces_path)
-
-    faces_path = os.path.join(get_checkpoint_path(), "*.pkl")
-    faces += glob.glob(faces_path)
-
-    return ["None"] + [os.path.basename(face) for face in sorted(faces)]
+    faces = [
+        face for face in _checkpoint_index() if face.endswith((".safetensors", ".pkl"))
+    ]
+    return ["None"] + sorted(faces)
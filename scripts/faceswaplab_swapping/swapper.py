@@ -9,6 +9,8 @@ from tqdm import tqdm
 import sys
 from io import StringIO
 from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import threading
 
 import cv2
 import insightface
@@ -39,6 +41,8 @@ from modules import shared
 import onnxruntime
 from scripts.faceswaplab_utils.sd_utils import get_sd_option
 
+ANALYSIS_MODEL_LOCK = threading.Lock()
+
 
 def use_gpu() -> bool:
     return (
@@ -415,9 +419,11 @@ def get_faces(
         x = get_sd_option("faceswaplab_det_size", 640)
         det_size = (x, x)
 
-    face_analyser = getAnalysisModel(
-        det_size=det_size, det_thresh=det_thresh, use_gpu=not is_cpu_provider()
-    )
+    # Model loading swaps sys.stdout, it must not run concurrently
+    with ANALYSIS_MODEL_LOCK:
+        face_analyser = getAnalysisModel(
+            det_size=det_size, det_thresh=det_thresh, use_gpu=not is_cpu_provider()
+        )
 
     # Get the detected faces from the image using the analysis model
     faces = face_analyser.get(img_data)
@@ -549,12 +555,15 @@ def get_faces_from_img_files(images: List[PILImage]) -> List[Face]:
     faces: List[Face] = []
 
     if len(images) > 0:
-        for img in images:
-            face = get_or_default(
-                get_faces(pil_to_cv2(img)), 0, None
-            )  # Extract faces from the image
-            if face is not None:
-                faces.append(face)  # Add the detected face to the list of faces
+
+        def first_face(img: PILImage) -> Optional[Face]:
+            return get_or_default(get_faces(pil_to_cv2(img)), 0, None)
+
+        # Conversion and inference release the GIL, so images are processed concurrently (order is kept)
+        with ThreadPoolExecutor(max_workers=min(8, len(images))) as executor:
+            faces = [
+                face for face in executor.map(first_face, images) if face is not None
+            ]
 
     return faces
 